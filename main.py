@@ -2,14 +2,75 @@ from fastapi import FastAPI, Header, HTTPException
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from urllib.parse import quote
-import os, requests, xml.etree.ElementTree as ET, zlib, binascii, re, traceback
-from typing import Optional, List
-
-app = FastAPI(title="Bluebeam BPX Import Service")
+from contextlib import asynccontextmanager
+import os, asyncio, httpx, orjson, zlib, gzip, hashlib, threading, time, re, traceback, multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from lxml import etree as ET
+from typing import Optional, List, NamedTuple
 
 IMPORT_API_KEY = os.environ.get("IMPORT_SERVICE_API_KEY", "")
 
 
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+# Gzip insert bodies above GZIP_MIN_BYTES. Off by default: only enable when the
+# gateway in front of PostgREST decodes Content-Encoding: gzip request bodies.
+GZIP_REQUEST_BODIES = _env_flag("GZIP_REQUEST_BODIES")
+GZIP_MIN_BYTES = 1024
+
+# The decoded PDF dictionary is only useful for debugging mappings; it's up to
+# 4 KB per tool on the wire, so it's opt-in.
+STORE_RAW_DECODED = _env_flag("STORE_RAW_DECODED")
+RAW_DECODED_MAX_BYTES = 4000
+
+# PostgREST inserts a JSON array in a single statement; keep each POST bounded.
+INSERT_BATCH_SIZE = 1000
+
+# Whether each Supabase URL's database has import_bluebeam_bpx, as (available, checked at);
+# re-probed after RPC_PROBE_TTL seconds so installing the function later takes effect.
+RPC_PROBE_TTL = 300.0
+_RPC_AVAILABILITY: dict = {}
+
+# One shared HTTP/2 client so concurrent Supabase calls multiplex over kept-alive connections.
+CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=None,
+)
+
+
+# CPUs this process may actually run on, which in a container can be fewer than the host has.
+CPU_COUNT = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+# Inflating and scanning ToolChestItem payloads is CPU-bound; spread it across cores.
+# The pool starts from worker threads while the HTTP client and executors are live, and
+# forking a multithreaded process can deadlock the child, so workers come from a forkserver.
+POOL = ProcessPoolExecutor(max_workers=CPU_COUNT, mp_context=multiprocessing.get_context("forkserver"))
+POOL_CHUNKSIZE = 32
+# Below this many items pickling and IPC cost more than the work itself; smaller batches
+# run on threads instead, which still inflate in parallel since zlib releases the GIL.
+POOL_MIN_ITEMS = 64
+THREADS = ThreadPoolExecutor(max_workers=CPU_COUNT)
+# Profiles often repeat the same tool across toolsets; remember decoded payloads, up to
+# roughly this many bytes of results, in the parent process.
+DECODE_CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await CLIENT.aclose()
+    POOL.shutdown()
+    THREADS.shutdown()
+
+
+app = FastAPI(title="Bluebeam BPX Import Service", lifespan=lifespan)
+
+
 class ImportReq(BaseModel):
     project_id: Optional[str] = None
     storage_bucket: str = "imports"
@@ -28,45 +89,45 @@ def sb_headers(service_key: str):
     }
 
 
-def decode_hex_zlib(hex_str: str) -> str:
+def decode_hex_zlib_bytes(hex_str: str) -> bytes:
     hex_str = (hex_str or "").strip()
     if not hex_str:
-        return ""
-    raw = binascii.unhexlify(hex_str)
-    out = zlib.decompress(raw)
-    return out.decode("utf-8", errors="replace")
+        return b""
+    return zlib.decompress(bytes.fromhex(hex_str))
+
 
+def decode_hex_zlib(hex_str: str) -> str:
+    return decode_hex_zlib_bytes(hex_str).decode("utf-8", errors="replace")
+
+
+_SUBJ_RE = re.compile(rb"/Subj\((.*?)\)")
+_IT_RE = re.compile(rb"/IT/([A-Za-z0-9]+)")
+_ARR_RE = {k: re.compile(rb"/%s\s*\[\s*([0-9.\s]+)\]" % k) for k in (b"C", b"IC", b"D")}
+_NUM_RE = {k: re.compile(rb"/%s\s+([0-9.]+)" % k) for k in (b"CA", b"LW")}
 
-def extract_pdf_dict_fields(raw: str):
-    subj = None
-    m = re.search(r"/Subj\((.*?)\)", raw)
-    if m:
-        subj = m.group(1)
 
-    it = None
-    m = re.search(r"/IT/([A-Za-z0-9]+)", raw)
-    if m:
-        it = m.group(1)
+def extract_pdf_dict_fields(raw: bytes):
+    m = _SUBJ_RE.search(raw)
+    subj = m.group(1) if m else None
+
+    m = _IT_RE.search(raw)
+    it = m.group(1).decode("ascii") if m else None
 
     def extract_array(key):
-        m2 = re.search(rf"/{key}\s*\[\s*([0-9.\s]+)\]", raw)
-        if not m2:
-            return None
-        return [float(x) for x in m2.group(1).split() if x.strip()]
+        m2 = _ARR_RE[key].search(raw)
+        return [float(x) for x in m2.group(1).split()] if m2 else None
 
     def extract_num(key):
-        m2 = re.search(rf"/{key}\s+([0-9.]+)", raw)
+        m2 = _NUM_RE[key].search(raw)
         return float(m2.group(1)) if m2 else None
 
-    style = {}
-    C = extract_array("C")
-    IC = extract_array("IC")
-    CA = extract_num("CA")
-    LW = extract_num("LW")
-
-    md = re.search(r"/D\s*\[\s*([0-9.\s]+)\]", raw)
-    D = [float(x) for x in md.group(1).split() if x.strip()] if md else None
+    CA = extract_num(b"CA")
+    LW = extract_num(b"LW")
+    C = extract_array(b"C")
+    IC = extract_array(b"IC")
+    D = extract_array(b"D")
 
+    style = {}
     if C:
         style["stroke_rgb"] = C[:3]
     if IC:
@@ -104,51 +165,329 @@ SKIP_TYPES = {
 }
 
 
+def _child_text(elem, tag: str) -> str:
+    """Text of the first direct child named `tag`, without going through ElementPath."""
+    for child in elem.iterchildren(tag):
+        return child.text or ""
+    return ""
+
+
+TOOLSET_TAG = "BluebeamRevuToolSet"
+SKIP_TOOLSET_TITLES = ("Recent Tools", "Seneste vaerktoejer")
+
+
+def _read_toolset(ts_idx: int, ts):
+    """Title and (item index, Raw hex) pairs of a parsed toolset; title is None if it can't be decoded."""
+    title_hex = _child_text(ts, "Title")
+    try:
+        title = decode_hex_zlib(title_hex) if title_hex else f"Toolset {ts_idx + 1}"
+    except Exception:
+        title = None
+
+    jobs = []
+    if title not in SKIP_TOOLSET_TITLES:
+        for i, item in enumerate(ts.iter("ToolChestItem")):
+            raw_hex = _child_text(item, "Raw")
+            if raw_hex:
+                jobs.append((i, raw_hex))
+    return ts_idx, title, jobs
+
+
+class _ToolsetReader:
+    """Incremental BPX parser: feed() returns the toolsets completed by each chunk.
+
+    Toolsets come out as findall(".//BluebeamRevuToolSet") would list them: in document
+    order and never the root element. A nested toolset's items also belong to the
+    toolsets around it, so it is held back until the outermost one ends; elements are
+    released then. lxml trees belong to the thread that builds them, so drive a reader
+    from a single thread.
+    """
+
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=("start", "end"), tag=TOOLSET_TAG)
+        self._ts_idx = -1
+        self._open: List[int] = []  # ts_idx of each toolset not yet ended, outermost first
+        self._ended: list = []  # toolsets ended inside the current outermost one
+
+    def feed(self, chunk: bytes) -> list:
+        self._parser.feed(chunk)
+        return self._drain()
+
+    def close(self) -> list:
+        self._parser.close()
+        return self._drain()
+
+    def _drain(self) -> list:
+        done = []
+        for event, ts in self._parser.read_events():
+            if ts.getparent() is None:
+                continue
+            if event == "start":
+                self._ts_idx += 1
+                self._open.append(self._ts_idx)
+                continue
+            self._ended.append(_read_toolset(self._open.pop(), ts))
+            if not self._open:
+                done.extend(sorted(self._ended, key=lambda parsed: parsed[0]))
+                self._ended.clear()
+                _release(ts)
+        return done
+
+
+async def _parse_toolsets(chunks):
+    """Yield (ts_idx, title, jobs) per toolset while keeping all XML work off the event loop."""
+    reader = _ToolsetReader()
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max_workers=1) as xml_thread:
+        async for chunk in chunks:
+            for parsed in await loop.run_in_executor(xml_thread, reader.feed, chunk):
+                yield parsed
+        for parsed in await loop.run_in_executor(xml_thread, reader.close):
+            yield parsed
+
+
+def _release(elem):
+    """Free a processed outermost toolset and the processed toolsets just before it."""
+    elem.clear()
+    prev = elem.getprevious()
+    while prev is not None and prev.tag == TOOLSET_TAG:
+        earlier = prev.getprevious()
+        elem.getparent().remove(prev)
+        prev = earlier
+
+
 def map_tool_kind(it: Optional[str]) -> str:
     if not it:
         return "count"
+    return _map_it_kind(it)
+
+
+# A BPX only uses a handful of distinct IT values, so after warm-up this is one dict probe.
+@lru_cache(maxsize=256)
+def _map_it_kind(it: str) -> str:
     short = it.split(".")[-1].lower()
     if short in SKIP_TYPES:
         return "skip"
     return TYPE_MAP.get(short, "count")
 
 
-def sb_download(supabase_url: str, service_key: str, bucket: str, path: str) -> str:
-    """Download file from Supabase Storage directly using service role key."""
+async def sb_download_stream(supabase_url: str, service_key: str, bucket: str, path: str):
+    """Stream a file from Supabase Storage using the service role key, yielding body chunks.
+
+    httpx advertises gzip/deflate and decodes transparently, so chunks are always raw bytes.
+    """
     encoded_path = quote(path, safe="/")
     url = f"{supabase_url}/storage/v1/object/{bucket}/{encoded_path}"
     headers = {
         "apikey": service_key,
         "Authorization": f"Bearer {service_key}",
     }
-    r = requests.get(url, headers=headers)
-    if r.status_code >= 300:
-        raise RuntimeError(f"Failed to download file: {r.status_code} url={url} body={r.text[:500]}")
-    return r.text
+    async with CLIENT.stream("GET", url, headers=headers) as r:
+        if r.status_code >= 300:
+            await r.aread()
+            raise RuntimeError(f"Failed to download file: {r.status_code} url={url} body={r.text[:500]}")
+        async for chunk in r.aiter_bytes():
+            yield chunk
+
+
+def _encode_body(payload, headers: dict):
+    """Serialize a JSON body, gzip-compressing it when enabled and large enough to pay off."""
+    body = orjson.dumps(payload)
+    if GZIP_REQUEST_BODIES and len(body) > GZIP_MIN_BYTES:
+        return gzip.compress(body, compresslevel=6), {**headers, "Content-Encoding": "gzip"}
+    return body, headers
+
+
+def _chunks(rows: List[dict], size: int = INSERT_BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
 
 
-def sb_insert(supabase_url: str, service_key: str, table: str, row: dict) -> dict:
+async def sb_insert_many(supabase_url: str, service_key: str, table: str, rows: List[dict],
+                         select: str = "id") -> List[dict]:
+    """Insert rows as JSON-array POSTs of up to INSERT_BATCH_SIZE and return them in order.
+
+    Only the `select` columns come back in the representation, so callers that just
+    need generated ids don't pay for echoing the whole row. Chunks are sent concurrently.
+    """
+    url = f"{supabase_url}/rest/v1/{table}?select={select}"
+    headers = sb_headers(service_key)
+
+    async def post(chunk: List[dict]) -> List[dict]:
+        body, body_headers = await asyncio.to_thread(_encode_body, chunk, headers)
+        r = await CLIENT.post(url, headers=body_headers, content=body)
+        if r.status_code >= 300:
+            raise RuntimeError(f"Insert {table} failed: {r.status_code} {r.text[:500]}")
+        return orjson.loads(r.content)
+
+    results = await asyncio.gather(*[post(chunk) for chunk in _chunks(rows)])
+    return [row for chunk in results for row in chunk]
+
+
+async def sb_insert(supabase_url: str, service_key: str, table: str, row: dict, select: str = "id") -> dict:
     """Insert a row and return it (with generated id)."""
-    url = f"{supabase_url}/rest/v1/{table}"
-    r = requests.post(url, headers=sb_headers(service_key), json=row)
+    return (await sb_insert_many(supabase_url, service_key, table, [row], select))[0]
+
+
+async def sb_rpc(supabase_url: str, service_key: str, fn: str, params: dict):
+    """Call a Postgres function through PostgREST; None if the function doesn't exist."""
+    url = f"{supabase_url}/rest/v1/rpc/{fn}"
+    body, headers = await asyncio.to_thread(_encode_body, params, sb_headers(service_key))
+    r = await CLIENT.post(url, headers=headers, content=body)
+    if r.status_code == 404:
+        return None
     if r.status_code >= 300:
-        raise RuntimeError(f"Insert {table} failed: {r.status_code} {r.text[:500]}")
-    data = r.json()
-    return data[0] if isinstance(data, list) and data else data
+        raise RuntimeError(f"RPC {fn} failed: {r.status_code} {r.text[:500]}")
+    return orjson.loads(r.content)
 
 
-def sb_delete_where(supabase_url: str, service_key: str, table: str, where: str):
+async def sb_delete_where(supabase_url: str, service_key: str, table: str, where: str):
     url = f"{supabase_url}/rest/v1/{table}?{where}"
-    r = requests.delete(url, headers=sb_headers(service_key))
+    r = await CLIENT.delete(url, headers=sb_headers(service_key))
+
+
+# Inflate this much of a Raw payload first; /IT usually sits near the start of the dictionary.
+SKIP_PROBE_BYTES = 2048
+
+
+def _inflate_tool(raw_hex: str):
+    """Inflate a Raw payload, stopping early if its /IT is a kind we skip.
+
+    Returns (raw, None) for a full payload or (None, it) for a skipped one.
+    """
+    data = bytes.fromhex(raw_hex.strip())
+    if not data:
+        return b"", None
+    d = zlib.decompressobj()
+    head = d.decompress(data, SKIP_PROBE_BYTES)
+    m = _IT_RE.search(head)
+    # A match running into the end of the prefix may be a truncated name; only trust complete ones.
+    if m and m.end() < len(head):
+        it = m.group(1).decode("ascii")
+        if map_tool_kind(it) == "skip":
+            return None, it
+    raw = head + d.decompress(d.unconsumed_tail) + d.flush()
+    if not d.eof:
+        raise zlib.error("incomplete or truncated stream")
+    return raw, None
+
+
+def _decode_and_extract(raw_hex: str):
+    """Pool worker: inflate one Raw payload and extract its fields; None if it can't be decoded."""
+    try:
+        raw, skipped_it = _inflate_tool(raw_hex)
+    except Exception:
+        return None
+    if raw is None:
+        return None, None, skipped_it, {}
+    subj, it, style = extract_pdf_dict_fields(raw)
+    raw_decoded = raw[:RAW_DECODED_MAX_BYTES].decode("utf-8", errors="replace") if STORE_RAW_DECODED else None
+    return raw_decoded, subj, it, style
+
+
+_MISSING = object()
+
+
+class _DecodeCache:
+    """Thread-safe LRU of _decode_and_extract results, bounded by the approximate bytes held.
+
+    Keys are digests of the hex payload, so a multi-KB Raw string is never kept alive by the cache.
+    Results are shared between callers; the style dicts in them must not be mutated.
+    """
+
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(raw_hex: str) -> bytes:
+        return hashlib.blake2b(raw_hex.encode("utf-8"), digest_size=16).digest()
+
+    def get(self, key: bytes):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: bytes, result):
+        size = self.ENTRY_OVERHEAD
+        if result is not None:
+            raw_decoded, subj, _, _ = result
+            size += len(raw_decoded or "") + len(subj or b"")
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+
+
+_DECODE_CACHE = _DecodeCache(DECODE_CACHE_MAX_BYTES)
+
+
+def _decode_items(raw_hexes: List[str], abandoned: Optional[threading.Event] = None) -> list:
+    """Decode payloads in order; cache hits are answered here and only misses reach the pool.
+
+    Once `abandoned` is set the remaining results are dropped, which cancels pool chunks not yet started.
+    """
+    keys = [_DECODE_CACHE.key(raw_hex) for raw_hex in raw_hexes]
+    results = {}
+    misses = {}
+    for key, raw_hex in zip(keys, raw_hexes):
+        if key in results or key in misses:
+            continue
+        cached = _DECODE_CACHE.get(key)
+        if cached is _MISSING:
+            misses[key] = raw_hex
+        else:
+            results[key] = cached
+
+    if misses and not (abandoned and abandoned.is_set()):
+        executor = THREADS if len(misses) < POOL_MIN_ITEMS else POOL
+        decoded = executor.map(_decode_and_extract, misses.values(), chunksize=POOL_CHUNKSIZE)
+        for key, result in zip(misses, decoded):
+            if abandoned and abandoned.is_set():
+                return []
+            _DECODE_CACHE.put(key, result)
+            results[key] = result
+
+    return [results[key] for key in keys]
+
+
+class ParsedToolset(NamedTuple):
+    """One imported BluebeamRevuToolSet, kept until its profile exists."""
+    ts_idx: int  # sort_index in the BPX
+    title: str
+
+
+class ParsedTool(NamedTuple):
+    """One importable ToolChestItem, kept until its foreign keys exist."""
+    ts_pos: int  # position in the parsed toolsets list
+    ts_idx: int  # toolset sort_index in the BPX
+    i: int  # item index within the toolset
+    name: str
+    kind: str
+    title: str  # toolset title, used as the category
+    it: Optional[str]
+    style: dict  # shared by the tool and preset rows; serialized, never copied
+    raw_decoded: Optional[str]
 
 
 @app.post("/import-bpx")
-def import_bpx(req: ImportReq, authorization: str = Header(default="")):
+async def import_bpx(req: ImportReq, authorization: str = Header(default="")):
     if not IMPORT_API_KEY or authorization != f"Bearer {IMPORT_API_KEY}":
         raise HTTPException(status_code=401, detail="Unauthorized")
 
     try:
-        return _do_import(req)
+        return await _do_import(req)
     except Exception as e:
         tb = traceback.format_exc()
         print(f"[import-bpx] ERROR: {e}\n{tb}")
@@ -158,101 +497,176 @@ def import_bpx(req: ImportReq, authorization: str = Header(default="")):
         )
 
 
-def _do_import(req: ImportReq):
+async def _do_import(req: ImportReq):
     base = req.supabase_url
     key = req.supabase_service_role_key
 
-    # 1. Download BPX from Storage
-    xml_text = sb_download(base, key, req.storage_bucket, req.storage_path)
+    # 1. Stream the BPX from Storage into the parser, collecting named tuples;
+    #    rows are built in one pass once their foreign keys are known. Each toolset's
+    #    payloads start decoding as soon as it is parsed, overlapping the download.
+    warnings: List[str] = []
+    toolsets: List[ParsedToolset] = []
+    tools: List[ParsedTool] = []
+    pending = []
+
+    chunks = sb_download_stream(base, key, req.storage_bucket, req.storage_path)
+    abandoned = threading.Event()
 
-    # 2. Create bluebeam_profile
-    profile = sb_insert(base, key, "bluebeam_profiles", {
+    try:
+        async for ts_idx, title, jobs in _parse_toolsets(chunks):
+            if title is None:
+                title = f"Toolset {ts_idx + 1}"
+                warnings.append(f"Failed decoding toolset title at index {ts_idx}")
+
+            if title in SKIP_TOOLSET_TITLES:
+                continue
+
+            ts_pos = len(toolsets)
+            toolsets.append(ParsedToolset(ts_idx, title))
+            decoding = asyncio.ensure_future(asyncio.to_thread(
+                _decode_items, [raw_hex for _, raw_hex in jobs], abandoned))
+            pending.append((ts_pos, ts_idx, title, [i for i, _ in jobs], decoding))
+
+        for ts_pos, ts_idx, title, item_indexes, decoding in pending:
+            for i, result in zip(item_indexes, await decoding):
+                if result is None:
+                    warnings.append(f"Failed decoding tool in '{title}', item {i}")
+                    continue
+
+                raw_decoded, subj, it, style = result
+                tool_kind = map_tool_kind(it)
+                if tool_kind == "skip":
+                    continue
+
+                name = subj.decode("utf-8", errors="replace") if subj else f"Tool {i + 1}"
+                tools.append(ParsedTool(ts_pos, ts_idx, i, name, tool_kind, title, it, style, raw_decoded))
+    except BaseException:
+        # Don't leave this request's decodes using the pool, or their errors unretrieved.
+        abandoned.set()
+        decodes = [entry[-1] for entry in pending]
+        for decoding in decodes:
+            decoding.cancel()
+        await asyncio.gather(*decodes, return_exceptions=True)
+        raise
+
+    profile_row = {
         "project_id": req.project_id,
         "filename": req.filename,
         "version_label": None,
         "created_by": "00000000-0000-0000-0000-000000000000",
-    })
-    profile_id = profile["id"]
+    }
 
-    # 3. Parse BPX XML
-    root = ET.fromstring(xml_text)
-    toolsets_imported = 0
-    tools_imported = 0
-    presets_created = 0
-    warnings: List[str] = []
+    # 2. Insert the profile with its toolsets, tools and presets in one transactional RPC
+    #    when the database has import_bluebeam_bpx (sql/import_bluebeam_bpx.sql)
+    result = None
+    if await _has_import_rpc(base, key):
+        params = await asyncio.to_thread(_rpc_params, req.project_id, profile_row, toolsets, tools)
+        result = await sb_rpc(base, key, "import_bluebeam_bpx", params)
+        if result is None:
+            _RPC_AVAILABILITY[base] = (False, time.monotonic())
+
+    if result is not None:
+        profile_id = result["profile_id"]
+        presets_created = result["presets"]
+    else:
+        # 3. Otherwise create bluebeam_profile, then insert the rest in batches
+        profile = await sb_insert(base, key, "bluebeam_profiles", profile_row)
+        profile_id = profile["id"]
+        presets_created = await _insert_batched(base, key, req.project_id, profile_id, toolsets, tools, warnings)
+
+    return {
+        "profileId": profile_id,
+        "toolsetCount": len(toolsets),
+        "toolCount": len(tools),
+        "presetCount": presets_created,
+        "missingReferences": [],
+        "warnings": warnings,
+    }
 
-    toolset_els = root.findall(".//BluebeamRevuToolSet")
 
-    for ts_idx, ts in enumerate(toolset_els):
-        title_hex = ts.findtext("Title") or ""
-        try:
-            title = decode_hex_zlib(title_hex) if title_hex else f"Toolset {ts_idx + 1}"
-        except Exception:
-            title = f"Toolset {ts_idx + 1}"
-            warnings.append(f"Failed decoding toolset title at index {ts_idx}")
+def _toolset_row(profile_id, toolset: ParsedToolset) -> dict:
+    return {"profile_id": profile_id, "title": toolset.title, "sort_index": toolset.ts_idx, "source_path": None}
 
-        if title in ("Recent Tools", "Seneste vaerktoejer"):
-            continue
 
-        ts_row = sb_insert(base, key, "bluebeam_toolsets", {
-            "profile_id": profile_id,
-            "title": title,
-            "sort_index": ts_idx,
-            "source_path": None,
-        })
-        toolset_id = ts_row["id"]
-        toolsets_imported += 1
-
-        items = ts.findall(".//ToolChestItem")
-        for i, item in enumerate(items):
-            raw_hex = item.findtext("Raw") or ""
-            if not raw_hex:
-                continue
-            try:
-                raw = decode_hex_zlib(raw_hex)
-            except Exception:
-                warnings.append(f"Failed decoding tool in '{title}', item {i}")
-                continue
+def _tool_row(toolset_id, tool: ParsedTool) -> dict:
+    row = {
+        "toolset_id": toolset_id,
+        "name": tool.name,
+        "tool_kind": tool.kind,
+        "sort_index": tool.i,
+        "style_json": tool.style,
+        "mapping_json": {"it": tool.it, "category": tool.title},
+    }
+    if STORE_RAW_DECODED:
+        row["raw_decoded"] = tool.raw_decoded
+    return row
 
-            subj, it, style = extract_pdf_dict_fields(raw)
-            tool_kind = map_tool_kind(it)
-            if tool_kind == "skip":
-                continue
 
-            name = subj or f"Tool {i + 1}"
-
-            tool_row = sb_insert(base, key, "bluebeam_tools", {
-                "toolset_id": toolset_id,
-                "name": name,
-                "tool_kind": tool_kind,
-                "sort_index": i,
-                "raw_decoded": raw[:4000],
-                "style_json": style,
-                "mapping_json": {"it": it, "category": title},
-            })
-            tools_imported += 1
-
-            preset = {
-                "project_id": req.project_id,
-                "name": name,
-                "tool_type": tool_kind,
-                "category": title,
-                "style_json": style,
-                "default_tags_json": {},
-                "sort_index": ts_idx * 1000 + i,
-                "bluebeam_tool_id": tool_row["id"],
-            }
-            try:
-                sb_insert(base, key, "presets", preset)
-                presets_created += 1
-            except Exception as e:
-                warnings.append(f"Failed preset for '{name}': {str(e)}")
+def _preset_row(project_id, tool_id, tool: ParsedTool) -> dict:
+    return {
+        "project_id": project_id,
+        "name": tool.name,
+        "tool_type": tool.kind,
+        "category": tool.title,
+        "style_json": tool.style,
+        "default_tags_json": {},
+        "sort_index": tool.ts_idx * 1000 + tool.i,
+        "bluebeam_tool_id": tool_id,
+    }
+
+
+async def _has_import_rpc(base: str, key: str) -> bool:
+    """Whether import_bluebeam_bpx exists, checked with a null-profile call that inserts nothing."""
+    cached = _RPC_AVAILABILITY.get(base)
+    if cached is not None and time.monotonic() - cached[1] < RPC_PROBE_TTL:
+        return cached[0]
+    available = await sb_rpc(base, key, "import_bluebeam_bpx", {"p_profile": None, "p_toolsets": []}) is not None
+    _RPC_AVAILABILITY[base] = (available, time.monotonic())
+    return available
 
+
+def _rpc_params(project_id, profile_row: dict, toolsets: List[ParsedToolset], tools: List[ParsedTool]) -> dict:
+    """Nest rows as import_bluebeam_bpx expects; the function fills in the generated foreign keys."""
+    by_toolset: List[List[ParsedTool]] = [[] for _ in toolsets]
+    for tool in tools:
+        by_toolset[tool.ts_pos].append(tool)
     return {
-        "profileId": profile_id,
-        "toolsetCount": toolsets_imported,
-        "toolCount": tools_imported,
-        "presetCount": presets_created,
-        "missingReferences": [],
-        "warnings": warnings,
+        "p_profile": profile_row,
+        "p_toolsets": [
+            {
+                "row": _toolset_row(None, toolset),
+                "tools": [
+                    {"row": _tool_row(None, tool), "preset": _preset_row(project_id, None, tool)}
+                    for tool in ts_tools
+                ],
+            }
+            for toolset, ts_tools in zip(toolsets, by_toolset)
+        ],
     }
+
+
+async def _insert_batched(base: str, key: str, project_id, profile_id, toolsets: List[ParsedToolset],
+                          tools: List[ParsedTool], warnings: List[str]) -> int:
+    """Insert toolsets, then tools, then presets; chunks of each batch go out concurrently.
+
+    Returns the number of presets created; failed preset chunks are reported in `warnings`.
+    """
+    toolset_rows = [_toolset_row(profile_id, toolset) for toolset in toolsets]
+    toolset_ids = [row["id"] for row in await sb_insert_many(base, key, "bluebeam_toolsets", toolset_rows)]
+
+    tool_rows = [_tool_row(toolset_ids[tool.ts_pos], tool) for tool in tools]
+    tool_ids = [row["id"] for row in await sb_insert_many(base, key, "bluebeam_tools", tool_rows)]
+
+    preset_rows = [_preset_row(project_id, tool_id, tool) for tool, tool_id in zip(tools, tool_ids)]
+    preset_chunks = list(_chunks(preset_rows))
+    results = await asyncio.gather(
+        *[sb_insert_many(base, key, "presets", chunk) for chunk in preset_chunks],
+        return_exceptions=True,
+    )
+    presets_created = 0
+    for chunk, result in zip(preset_chunks, results):
+        if isinstance(result, Exception):
+            warnings.append(f"Failed {len(chunk)} presets starting at '{chunk[0]['name']}': {str(result)}")
+        else:
+            presets_created += len(chunk)
+    return presets_created
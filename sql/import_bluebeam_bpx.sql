@@ -0,0 +1,97 @@
+-- Single round-trip BPX import, called by the import service as
+-- POST /rest/v1/rpc/import_bluebeam_bpx.
+--
+-- p_profile:  {<bluebeam_profiles row>}, or null to only check that the function exists
+-- p_toolsets: [{"row": {<bluebeam_toolsets row>},
+--               "tools": [{"row": {<bluebeam_tools row>}, "preset": {<presets row>}}, ...]}, ...]
+--
+-- The profile and everything under it are inserted in one transaction, so a failure
+-- leaves no rows behind. Generated ids flow profile -> toolsets -> tools -> presets
+-- through RETURNING; the foreign keys in the JSON rows are ignored.
+-- Returns the profile id and the inserted row counts ({} for the null-profile probe).
+
+create or replace function public.import_bluebeam_bpx(p_profile jsonb, p_toolsets jsonb)
+returns jsonb
+language plpgsql
+set search_path = ''
+as $$
+declare
+  v_profile_id public.bluebeam_profiles.id%type;
+  result jsonb;
+begin
+  if p_profile is null then
+    return '{}'::jsonb;
+  end if;
+
+  insert into public.bluebeam_profiles (project_id, filename, version_label, created_by)
+  select r.project_id, r.filename, r.version_label, r.created_by
+  from jsonb_populate_record(null::public.bluebeam_profiles, p_profile) as r
+  returning id into v_profile_id;
+
+  with src_toolsets as (
+    select
+      jsonb_populate_record(
+        null::public.bluebeam_toolsets,
+        ts.value->'row' || jsonb_build_object('profile_id', v_profile_id)
+      ) as r,
+      ts.value->'tools' as tools
+    from jsonb_array_elements(p_toolsets) as ts(value)
+  ),
+  ins_toolsets as (
+    insert into public.bluebeam_toolsets (profile_id, title, sort_index, source_path)
+    select (r).profile_id, (r).title, (r).sort_index, (r).source_path
+    from src_toolsets
+    returning id, sort_index
+  ),
+  src_tools as (
+    select
+      jsonb_populate_record(
+        null::public.bluebeam_tools,
+        t.value->'row' || jsonb_build_object('toolset_id', ins_toolsets.id)
+      ) as r,
+      t.value->'preset' as preset
+    from src_toolsets
+    join ins_toolsets on ins_toolsets.sort_index = (src_toolsets.r).sort_index
+    cross join lateral jsonb_array_elements(src_toolsets.tools) as t(value)
+  ),
+  ins_tools as (
+    insert into public.bluebeam_tools
+      (toolset_id, name, tool_kind, sort_index, raw_decoded, style_json, mapping_json)
+    select (r).toolset_id, (r).name, (r).tool_kind, (r).sort_index,
+           (r).raw_decoded, (r).style_json, (r).mapping_json
+    from src_tools
+    returning id, toolset_id, sort_index
+  ),
+  src_presets as (
+    select
+      jsonb_populate_record(
+        null::public.presets,
+        src_tools.preset || jsonb_build_object('bluebeam_tool_id', ins_tools.id)
+      ) as p
+    from src_tools
+    join ins_tools on ins_tools.toolset_id = (src_tools.r).toolset_id
+                  and ins_tools.sort_index = (src_tools.r).sort_index
+  ),
+  ins_presets as (
+    insert into public.presets
+      (project_id, name, tool_type, category, style_json, default_tags_json, sort_index, bluebeam_tool_id)
+    select (p).project_id, (p).name, (p).tool_type, (p).category,
+           (p).style_json, (p).default_tags_json, (p).sort_index, (p).bluebeam_tool_id
+    from src_presets
+    returning id
+  )
+  select jsonb_build_object(
+    'profile_id', v_profile_id,
+    'toolsets', (select count(*) from ins_toolsets),
+    'tools', (select count(*) from ins_tools),
+    'presets', (select count(*) from ins_presets)
+  ) into result;
+
+  return result;
+end;
+$$;
+
+-- Functions are executable by PUBLIC by default and Supabase exposes them over
+-- PostgREST; only the service role may import.
+revoke execute on function public.import_bluebeam_bpx(jsonb, jsonb) from public, anon, authenticated;
+grant execute on function public.import_bluebeam_bpx(jsonb, jsonb) to service_role;